@@ -7,13 +7,59 @@
 """
 
 import streamlit as st
+import numpy as np
 import zipfile
-import json
+import orjson
 import xml.etree.ElementTree as ET
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, NamedTuple, Optional, Tuple
 import io
+import os
+import sys
+import gzip
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain
 from pathlib import Path
 
+try:
+    from lxml import etree as LET
+except ImportError:  # lxmlが無い環境では標準ライブラリのパーサーを使用
+    LET = None
+
+# パースエラーとして扱う例外
+XML_PARSE_ERRORS = (ET.ParseError,) if LET is None else (ET.ParseError, LET.XMLSyntaxError)
+
+EMPTY_COORDS = np.empty((0, 2))
+# 座標をまとめてパースする建物の件数
+COORDINATE_BATCH_SIZE = 1000
+# 3点のポリゴンを表せる座標文字列の最小の長さ（1桁の数値6個と区切りの空白5個）
+MIN_POSLIST_LENGTH = 11
+
+
+class BuildingFeature(NamedTuple):
+    """建物フィーチャー（(N, 2)の座標配列と属性）
+    
+    建物ごとにdictを持つとメモリ消費が大きいため、GeoJSONへの変換は出力時に行う
+    """
+    coords: np.ndarray
+    source_file: Optional[str] = None
+    fid: Optional[str] = None
+    type: Optional[str] = None
+    orgGILvl: Optional[str] = None
+    gml_id: Optional[str] = None
+
+
+# 出力するプロパティ名（出力順）
+PROPERTY_NAMES = BuildingFeature._fields[1:]
+
+# 出力形式（表示名: (GDALのドライバー名, 拡張子, MIMEタイプ)）
+OUTPUT_FORMATS = {
+    'GeoJSON': ('GeoJSON', 'geojson', 'application/geo+json'),
+    'FlatGeobuf': ('FlatGeobuf', 'fgb', 'application/octet-stream'),
+    'GeoPackage': ('GPKG', 'gpkg', 'application/geopackage+sqlite3'),
+}
+
 
 class FastXMLToGeoJSONConverter:
     """基盤地図情報のXMLを高速でGeoJSONに変換するクラス"""
@@ -21,152 +67,366 @@ class FastXMLToGeoJSONConverter:
     def __init__(self):
         self.fgd_ns = '{http://fgd.gsi.go.jp/spec/2008/FGD_GMLSchema}'
         self.gml_ns = '{http://www.opengis.net/gml/3.2}'
+        self.blda_tag = f'{self.fgd_ns}BldA'
+        self.poslist_tag = f'{self.gml_ns}posList'
+        # 取得する属性の名前空間付きタグと、出力するプロパティ名の対応
+        self.property_tags = {
+            f'{self.fgd_ns}fid': 'fid',
+            f'{self.fgd_ns}type': 'type',
+            f'{self.fgd_ns}orgGILvl': 'orgGILvl',
+        }
+        self.gml_id_attr = f'{self.gml_ns}id'
+        # 種別（type）や精度（orgGILvl）は値の種類が少ないため、同じ値の文字列を共有する
+        self.shared_values = {}
+        # 処理中に発生した警告・エラー（(レベル, メッセージ)のリスト）
+        # ワーカープロセスからは画面に表示できないため、呼び出し元でまとめて表示する
+        self.messages = []
     
-    def parse_coordinates(self, coord_string: str) -> List[List[float]]:
-        """座標文字列をパースして座標のリストに変換"""
-        if not coord_string:
-            return []
-        
-        # 空白区切りの座標を処理（緯度 経度 緯度 経度 ...）
-        coord_parts = coord_string.strip().split()
-        coords = []
-        
-        for i in range(0, len(coord_parts), 2):
-            if i + 1 < len(coord_parts):
-                # 基盤地図情報では緯度、経度の順で格納されている
-                lat = float(coord_parts[i])
-                lon = float(coord_parts[i + 1])
-                # GeoJSONでは経度、緯度の順なので順序を入れ替え
-                coords.append([lon, lat])
+    def parse_coordinates_each(self, coord_strings: List[str]) -> List[np.ndarray]:
+        """座標文字列を1件ずつパース（不正な値を含む建物のみ空の座標配列とし、他の建物には影響させない）"""
+        coords_list = []
+        for coord_string in coord_strings:
+            try:
+                values = np.array(coord_string.split(), dtype=np.float64)
+            except ValueError:
+                coords_list.append(EMPTY_COORDS)
+                continue
+            
+            if values.size < 6 or values.size % 2:  # ポリゴンの場合、最低3点必要
+                coords_list.append(EMPTY_COORDS)
+            else:
+                # GeoJSONでは経度、緯度の順なので列を入れ替え（C連続の配列としてコピー）
+                coords_list.append(values.reshape(-1, 2)[:, ::-1].copy())
         
-        return coords
+        return coords_list
     
-    def parse_building_xml(self, xml_content: str, source_zip_name: str = None) -> List[Dict[str, Any]]:
-        """建物XMLファイルをパースしてGeoJSONフィーチャーのリストを返す"""
+    def parse_coordinates_batch(self, coord_strings: List[str]) -> List[np.ndarray]:
+        """複数の座標文字列をまとめてパースし、それぞれの座標配列のリストを返す
+        
+        建物ごとにNumPyを呼び出すと、頂点数の少ないポリゴンでは呼び出しのオーバーヘッドが
+        パース自体より大きくなるため、連結して1回の呼び出しでパースする
+        """
+        # 建物ごとの座標文字列をNaNで区切って連結し、一括でパース
+        # 不正な値を含む場合、NumPy 2.xでは例外になるが、NumPy 1.xでは警告のみで
+        # その手前でパースが打ち切られるため、警告も例外として扱い1件ずつパースし直す
         try:
-            root = ET.fromstring(xml_content)
-        except ET.ParseError as e:
-            st.error(f"XMLパースエラー: {e}")
-            return []
+            with warnings.catch_warnings():
+                warnings.simplefilter('error', DeprecationWarning)
+                values = np.fromstring(' nan '.join(coord_strings), dtype=np.float64, sep=' ')
+        except (ValueError, DeprecationWarning):
+            return self.parse_coordinates_each(coord_strings)
+        ends = np.flatnonzero(np.isnan(values)).tolist()
+        ends.append(values.size)
         
-        features = []
+        # 座標文字列中のnanでも区切りがずれるため、区切りの数が合わない場合は1件ずつパースし直す
+        if len(ends) != len(coord_strings):
+            return self.parse_coordinates_each(coord_strings)
         
-        # 建物要素を検索（名前空間付きで検索）
-        building_elements = root.findall(f'.//{self.fgd_ns}BldA')
+        coords_list = []
+        start = 0
+        for end in ends:
+            size = end - start
+            if size < 6 or size % 2:  # ポリゴンの場合、最低3点必要
+                coords_list.append(EMPTY_COORDS)
+            else:
+                # GeoJSONでは経度、緯度の順なので列を入れ替え（C連続の配列としてコピー）
+                coords_list.append(values[start:end].reshape(-1, 2)[:, ::-1].copy())
+            start = end + 1
+        
+        return coords_list
+    
+    def complete_features(self, pending: List[Tuple[Dict[str, Any], str]]) -> Iterator[BuildingFeature]:
+        """パース待ちの建物の座標をまとめてパースし、有効なポリゴンの建物フィーチャーを返す"""
+        coords_list = self.parse_coordinates_batch([coord_string for _, coord_string in pending])
+        for (properties, _), coords in zip(pending, coords_list):
+            if len(coords) >= 3:  # ポリゴンの場合、最低3点必要
+                yield BuildingFeature(coords, **properties)
+    
+    def iter_buildings(self, source):
+        """XMLを逐次パースしてBldA要素を順に返す（処理済みの要素はメモリから解放）"""
+        if LET is not None:
+            # 不正な箇所があっても例外で中断せず、読み取れた建物要素は処理を続ける
+            # IDの収集や空白のみのテキストは不要なため省き、巨大なファイルも制限なしで読み込む
+            # （外部の実体参照やネットワークへのアクセスは行わない）
+            context = LET.iterparse(
+                source, events=('end',), tag=self.blda_tag, recover=True,
+                collect_ids=False, remove_blank_text=True, huge_tree=True,
+                resolve_entities=False, no_network=True,
+            )
+            for _, building in context:
+                yield building
+                # 処理済みの建物要素と、それより前の兄弟要素を削除
+                building.clear(keep_tail=True)
+                while building.getprevious() is not None:
+                    del building.getparent()[0]
+            
+            # 読み飛ばしたエラーがあれば最初の1件を報告
+            errors = context.error_log.filter_from_errors()
+            if errors:
+                self.messages.append(('warning', f"XMLパースエラー（読み飛ばして続行）: {errors[0].message} (line {errors[0].line})"))
+        else:
+            context = ET.iterparse(source, events=('start', 'end'))
+            _, root = next(context)
+            for event, elem in context:
+                if event == 'end' and elem.tag == self.blda_tag:
+                    yield elem
+                    # 処理済みの要素をルートから削除
+                    root.clear()
+    
+    def iter_building_features(self, xml_file, source_zip_name: str = None) -> Iterator[BuildingFeature]:
+        """建物XMLファイルを逐次パースして建物フィーチャー（プロパティ, 座標）を順に返す"""
+        poslist_tag = self.poslist_tag
+        property_tags = self.property_tags
+        shared_values = self.shared_values
+        pending = []  # 座標のパース待ちの建物（プロパティ, 座標文字列）
         
-        # 各建物要素を処理
-        for building in building_elements:
-            # 座標を取得
-            poslist = building.find(f'.//{self.gml_ns}posList')
-            if poslist is not None and poslist.text:
-                coords = self.parse_coordinates(poslist.text)
+        try:
+            # 各建物要素を処理
+            for building in self.iter_buildings(xml_file):
+                # 座標を取得
+                poslist = next(building.iter(poslist_tag), None)
+                if poslist is None:
+                    continue
+                coord_string = poslist.text
+                if not coord_string or len(coord_string) < MIN_POSLIST_LENGTH:  # 空・3点未満は明らかに無効
+                    continue
                 
-                if len(coords) >= 3:  # ポリゴンの場合、最低3点必要
-                    # 属性情報を取得
-                    properties = {}
-                    
-                    # 元のZIPファイル名を先頭に追加
-                    if source_zip_name:
-                        properties['source_file'] = source_zip_name
-                    
-                    # 属性情報を取得
-                    for child in building:
-                        if child.tag.startswith('{') and child.tag.endswith('}'):
-                            tag_name = child.tag.split('}')[1]
-                        else:
-                            tag_name = child.tag
-                        
-                        if tag_name in ['fid', 'type', 'orgGILvl']:
-                            properties[tag_name] = child.text
-                    
-                    # gml:id属性も取得
-                    if 'gml:id' in building.attrib:
-                        properties['gml_id'] = building.attrib['gml:id']
-                    
-                    # フィーチャーを作成
-                    feature = {
-                        "type": "Feature",
-                        "geometry": {
-                            "type": "Polygon",
-                            "coordinates": [coords]
-                        },
-                        "properties": properties
-                    }
-                    
-                    features.append(feature)
+                # 属性情報を取得
+                properties = {}
+                
+                # 元のZIPファイル名を先頭に追加
+                if source_zip_name:
+                    properties['source_file'] = source_zip_name
+                
+                # 属性情報を取得
+                for child in building:
+                    name = property_tags.get(child.tag)
+                    if name is not None:
+                        text = child.text
+                        if name != 'fid':  # fidは建物ごとに異なるため共有しない
+                            text = shared_values.setdefault(text, text)
+                        properties[name] = text
+                
+                # gml:id属性も取得
+                gml_id = building.get(self.gml_id_attr)
+                if gml_id is not None:
+                    properties['gml_id'] = gml_id
+                
+                # 座標は一定件数ごとにまとめてパース
+                pending.append((properties, coord_string))
+                if len(pending) >= COORDINATE_BATCH_SIZE:
+                    yield from self.complete_features(pending)
+                    pending = []
+        except XML_PARSE_ERRORS as e:
+            self.messages.append(('error', f"XMLパースエラー: {e}"))
         
-        return features
+        # 残りの建物の座標をパース
+        yield from self.complete_features(pending)
+    
+    def find_building_files(self, file_list: List[str]) -> List[str]:
+        """ファイル名一覧から建物データ（-BldA-）のXMLファイルを抽出"""
+        return [f for f in file_list if '-BldA-' in f and f.endswith('.xml')]
     
-    def extract_and_convert_building_files(self, zip_data: bytes, zip_name: str) -> List[Dict[str, Any]]:
-        """ZIPファイルから建物ファイルを抽出してGeoJSONに変換
+    def extract_and_convert_building_files(self, zip_data: bytes, zip_name: str) -> List[BuildingFeature]:
+        """ZIPファイルから建物ファイルを抽出して建物フィーチャーに変換
         
         メインZIPファイル（中にサブZIPファイルが入っている）と
         サブZIPファイル（直接XMLファイルが入っている）の両方に対応
         """
         all_features = []
+        # すべての建物のsource_fileで同じ文字列オブジェクトを参照する
+        zip_name = sys.intern(zip_name)
         
         try:
             with zipfile.ZipFile(io.BytesIO(zip_data), 'r') as main_zip:
                 # メインZIP内のファイル一覧を取得
                 file_list = main_zip.namelist()
                 zip_files = [f for f in file_list if f.endswith('.zip')]
-                xml_files = [f for f in file_list if '-BldA-' in f and f.endswith('.xml')]
+                # サブZIPファイルが無い場合のみ、直接含まれる建物XMLファイルを検索
+                xml_files = self.find_building_files(file_list) if not zip_files else []
                 
                 # ケース1: メインZIPファイル（中にサブZIPファイルが入っている）
                 if zip_files:
                     for sub_zip_name in zip_files:
                         try:
-                            # サブZIPファイルを読み込み
-                            with main_zip.open(sub_zip_name) as sub_zip_data:
-                                with zipfile.ZipFile(sub_zip_data, 'r') as sub_zip:
-                                    # サブZIP内のファイル一覧を取得
-                                    sub_file_list = sub_zip.namelist()
-                                    
-                                    # -BldA-を含むファイルを検索
-                                    building_files = [f for f in sub_file_list if '-BldA-' in f and f.endswith('.xml')]
-                                    
-                                    for building_file in building_files:
-                                        try:
-                                            # XMLファイルを読み込み
-                                            with sub_zip.open(building_file) as xml_data:
-                                                xml_content = xml_data.read().decode('utf-8')
-                                            
-                                            # XMLをGeoJSONに変換（元のZIPファイル名を渡す）
-                                            features = self.parse_building_xml(xml_content, source_zip_name=zip_name)
-                                            all_features.extend(features)
-                                            
-                                        except Exception as e:
-                                            st.warning(f"エラー ({sub_zip_name}/{building_file}): {e}")
-                                            continue
+                            # サブZIPファイルをメモリに読み込む（ZIP内のストリームのままだと、
+                            # 中央ディレクトリの参照や各ファイルへのシークのたびに先頭から解凍し直しになる）
+                            sub_zip_data = io.BytesIO(main_zip.read(sub_zip_name))
+                            with zipfile.ZipFile(sub_zip_data, 'r') as sub_zip:
+                                # サブZIP内のファイル一覧を取得
+                                sub_file_list = sub_zip.namelist()
+                                
+                                # -BldA-を含むファイルを検索
+                                building_files = self.find_building_files(sub_file_list)
+                                
+                                for building_file in building_files:
+                                    try:
+                                        # XMLファイルを逐次読み込みながらGeoJSONに変換（元のZIPファイル名を渡す）
+                                        with sub_zip.open(building_file) as xml_data:
+                                            all_features.extend(self.iter_building_features(xml_data, source_zip_name=zip_name))
+                                        
+                                    except Exception as e:
+                                        self.messages.append(('warning', f"エラー ({sub_zip_name}/{building_file}): {e}"))
+                                        continue
                         except Exception as e:
-                            st.warning(f"サブZIPファイルの処理エラー ({sub_zip_name}): {e}")
+                            self.messages.append(('warning', f"サブZIPファイルの処理エラー ({sub_zip_name}): {e}"))
                             continue
                 
                 # ケース2: サブZIPファイル（直接XMLファイルが入っている）
                 elif xml_files:
                     for building_file in xml_files:
                         try:
-                            # XMLファイルを直接読み込み
+                            # XMLファイルを直接、逐次読み込みながらGeoJSONに変換（元のZIPファイル名を渡す）
                             with main_zip.open(building_file) as xml_data:
-                                xml_content = xml_data.read().decode('utf-8')
-                            
-                            # XMLをGeoJSONに変換（元のZIPファイル名を渡す）
-                            features = self.parse_building_xml(xml_content, source_zip_name=zip_name)
-                            all_features.extend(features)
+                                all_features.extend(self.iter_building_features(xml_data, source_zip_name=zip_name))
                             
                         except Exception as e:
-                            st.warning(f"エラー ({building_file}): {e}")
+                            self.messages.append(('warning', f"エラー ({building_file}): {e}"))
                             continue
                 
                 else:
-                    st.warning(f"ZIPファイル内に建物データ（-BldA-）が見つかりませんでした: {zip_name}")
+                    self.messages.append(('warning', f"ZIPファイル内に建物データ（-BldA-）が見つかりませんでした: {zip_name}"))
                     
         except Exception as e:
-            st.error(f"ZIPファイルの処理エラー ({zip_name}): {e}")
+            self.messages.append(('error', f"ZIPファイルの処理エラー ({zip_name}): {e}"))
         
         return all_features
 
 
+def to_geojson_feature(feature: BuildingFeature) -> Dict[str, Any]:
+    """建物フィーチャーからGeoJSONフィーチャーを作成（値の無い属性は出力しない）"""
+    properties = {name: value for name, value in zip(PROPERTY_NAMES, feature[1:]) if value is not None}
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [feature.coords]
+        },
+        "properties": properties
+    }
+
+
+def features_to_columns(features: List[BuildingFeature]) -> Tuple[np.ndarray, np.ndarray, Dict[str, list]]:
+    """建物フィーチャーを、全建物の頂点を連結した座標配列・建物ごとの頂点数・属性の列に変換"""
+    coords = np.concatenate([feature.coords for feature in features]) if features else EMPTY_COORDS
+    sizes = np.array([len(feature.coords) for feature in features], dtype=np.int64)
+    properties = {
+        name: [feature[i] for feature in features]
+        for i, name in enumerate(PROPERTY_NAMES, start=1)
+    }
+    return coords, sizes, properties
+
+
+def _convert_one(zip_data: bytes, zip_name: str, output_format: str = 'GeoJSON') -> Tuple[Any, int, List[Tuple[str, str]]]:
+    """1つのZIPファイルを変換する（ワーカープロセスで実行）
+    
+    プロセス間の転送量を抑えるため、GeoJSONの場合はフィーチャーをgzip圧縮したJSON Lines形式で、
+    それ以外の形式の場合は座標配列と属性の列（features_to_columnsの戻り値）で返す
+    """
+    converter = FastXMLToGeoJSONConverter()
+    features = converter.extract_and_convert_building_files(zip_data, zip_name)
+    if output_format != 'GeoJSON':
+        return features_to_columns(features), len(features), converter.messages
+    
+    lines = b'\n'.join(
+        orjson.dumps(to_geojson_feature(feature), option=orjson.OPT_SERIALIZE_NUMPY)
+        for feature in features
+    )
+    return gzip.compress(lines, compresslevel=1), len(features), converter.messages
+
+
+def merge_geojson(payloads: List[bytes]) -> Tuple[bytes, str]:
+    """各ZIPファイルの変換結果を1つのGeoJSONに結合し、プレビュー（最初の10件）とともに返す
+    
+    全フィーチャーを辞書としてメモリ上に保持せず、JSONのバイト列のまま逐次書き出す
+    """
+    geojson_buffer = io.BytesIO()
+    geojson_buffer.write(b'{"type":"FeatureCollection","features":[')
+    preview_features = []
+    for i, payload in enumerate(payloads):
+        lines = gzip.decompress(payload).splitlines()
+        if i:
+            geojson_buffer.write(b',')
+        geojson_buffer.write(b','.join(lines))
+        
+        # プレビュー用に最初の10件のみ辞書に戻す
+        preview_features.extend(orjson.loads(line) for line in lines[:10 - len(preview_features)])
+    geojson_buffer.write(b']}')
+    
+    # プレビューは最初の10件のみを一度だけシリアライズ
+    preview_json = orjson.dumps({
+        "type": "FeatureCollection",
+        "features": preview_features
+    }).decode('utf-8')
+    return geojson_buffer.getvalue(), preview_json
+
+
+def merge_vector_file(payloads: List[Tuple[np.ndarray, np.ndarray, Dict[str, list]]], output_format: str) -> Tuple[bytes, str]:
+    """各ZIPファイルの変換結果を結合してFlatGeobuf/GeoPackageに書き出し、プレビュー（最初の10件）とともに返す
+    
+    座標はNumPy配列のままShapelyのジオメトリに変換するため、頂点ごとのPython処理は行わない
+    """
+    # GeoJSON以外の形式でのみ使用するため、必要になった時点で読み込む
+    import geopandas as gpd
+    import shapely
+    
+    coords = np.concatenate([coords for coords, _, _ in payloads])
+    sizes = np.concatenate([sizes for _, sizes, _ in payloads])
+    
+    # 各建物を外周リング1つのポリゴンとして、連結した座標配列から一括でジオメトリを作成
+    ring_offsets = np.concatenate(([0], np.cumsum(sizes)))
+    polygon_offsets = np.arange(len(sizes) + 1)
+    geometry = shapely.from_ragged_array(shapely.GeometryType.POLYGON, coords, (ring_offsets, polygon_offsets))
+    
+    properties = {
+        name: list(chain.from_iterable(columns[name] for _, _, columns in payloads))
+        for name in PROPERTY_NAMES
+    }
+    gdf = gpd.GeoDataFrame(properties, geometry=geometry, crs='EPSG:4326')
+    
+    # GDALのドライバーはファイルに書き出すため、一時ディレクトリを経由してバイト列を取得
+    driver, extension, _ = OUTPUT_FORMATS[output_format]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = os.path.join(tmp_dir, f'buildings.{extension}')
+        # GeoPackageの主キー列の既定名（fid）は建物のfid属性と重なるため、別名にする
+        layer_options = {'FID': 'gpkg_fid'} if driver == 'GPKG' else {}
+        gdf.to_file(output_path, driver=driver, **layer_options)
+        with open(output_path, 'rb') as f:
+            output_bytes = f.read()
+    
+    return output_bytes, gdf.head(10).to_json()
+
+
+def show_result(result: Dict[str, Any]):
+    """変換結果（統計情報、ダウンロードボタン、プレビュー）を表示"""
+    output_bytes = result['output_bytes']
+    
+    # 結果を表示
+    st.success(f"✅ 変換完了！合計 {result['total_features']} 個の建物ポリゴンが変換されました")
+    
+    # 統計情報
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("処理したZIPファイル数", result['total_files'])
+    with col2:
+        st.metric("変換された建物数", result['total_features'])
+    with col3:
+        st.metric("出力ファイルサイズ", f"{len(output_bytes) / 1024 / 1024:.2f} MB")
+    
+    # ダウンロードボタン
+    st.download_button(
+        label=f"📥 {result['output_format']}ファイルをダウンロード",
+        data=output_bytes,
+        file_name=result['output_filename'],
+        mime=OUTPUT_FORMATS[result['output_format']][2],
+        use_container_width=True
+    )
+    
+    # プレビュー表示（最初の10件のみ）
+    with st.expander("📋 変換結果のプレビュー（最初の10件）"):
+        st.json(result['preview_json'])
+
+
 def main():
     st.set_page_config(
         page_title="基盤地図情報 XML to GeoJSON 変換",
@@ -194,84 +454,92 @@ def main():
     if uploaded_files:
         st.info(f"{len(uploaded_files)}個のZIPファイルがアップロードされました")
         
+        # 出力形式
+        output_format = st.radio(
+            "出力形式",
+            list(OUTPUT_FORMATS),
+            horizontal=True,
+            help="FlatGeobuf・GeoPackageは座標をバイナリで格納するため、GeoJSONより小さく高速に書き出せます"
+        )
+        
+        # アップロードされたファイルや出力形式が変わった場合は前回の変換結果を破棄
+        upload_key = (output_format,) + tuple((uploaded_file.name, uploaded_file.size) for uploaded_file in uploaded_files)
+        if st.session_state.get('upload_key') != upload_key:
+            st.session_state['upload_key'] = upload_key
+            st.session_state.pop('result', None)
+        
         # 変換ボタン
         if st.button("🔄 変換開始", type="primary", use_container_width=True):
-            converter = FastXMLToGeoJSONConverter()
-            all_features = []
             total_files = len(uploaded_files)
             
             # プログレスバー
             progress_bar = st.progress(0)
             status_text = st.empty()
+            status_text.text(f"処理中: {total_files}個のZIPファイルを並列に変換しています")
             
-            for idx, uploaded_file in enumerate(uploaded_files):
-                status_text.text(f"処理中: {uploaded_file.name} ({idx + 1}/{total_files})")
-                
-                # ZIPファイルを読み込み
-                zip_data = uploaded_file.read()
-                
-                # 変換処理
-                features = converter.extract_and_convert_building_files(zip_data, uploaded_file.name)
-                all_features.extend(features)
+            # 各ZIPファイルを別プロセスで並列に変換
+            results = [None] * total_files
+            max_workers = min(total_files, os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(_convert_one, uploaded_file.read(), uploaded_file.name, output_format): idx
+                    for idx, uploaded_file in enumerate(uploaded_files)
+                }
                 
-                # プログレスバーを更新
-                progress_bar.progress((idx + 1) / total_files)
+                for done, future in enumerate(as_completed(futures), start=1):
+                    idx = futures[future]
+                    results[idx] = future.result()
+                    status_text.text(f"処理完了: {uploaded_files[idx].name} ({done}/{total_files})")
+                    
+                    # プログレスバーを更新
+                    progress_bar.progress(done / total_files)
+            
+            # ワーカープロセスで発生した警告・エラーを表示
+            for _, _, messages in results:
+                for level, message in messages:
+                    getattr(st, level)(message)
+            
+            # アップロード順に結果を結合
+            total_features = sum(count for _, count, _ in results)
+            payloads = [payload for payload, count, _ in results if count]
+            if not payloads:
+                output_bytes, preview_json = b'', ''
+            elif output_format == 'GeoJSON':
+                output_bytes, preview_json = merge_geojson(payloads)
+            else:
+                output_bytes, preview_json = merge_vector_file(payloads, output_format)
             
             status_text.text("変換完了！")
             progress_bar.empty()
             
-            if all_features:
-                # GeoJSONファイルを作成
-                geojson_data = {
-                    "type": "FeatureCollection",
-                    "features": all_features
-                }
-                
-                # 結果を表示
-                st.success(f"✅ 変換完了！合計 {len(all_features)} 個の建物ポリゴンが変換されました")
-                
-                # 統計情報
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("処理したZIPファイル数", total_files)
-                with col2:
-                    st.metric("変換された建物数", len(all_features))
-                with col3:
-                    st.metric("出力ファイルサイズ", f"{len(json.dumps(geojson_data)) / 1024 / 1024:.2f} MB")
-                
-                # GeoJSONをJSON文字列に変換
-                geojson_json = json.dumps(geojson_data, ensure_ascii=False, indent=2)
-                
+            if total_features:
                 # 出力ファイル名を生成（入力ZIPファイル名を先頭に含める）
                 if total_files == 1:
                     # 1つのファイルの場合
                     base_name = Path(uploaded_files[0].name).stem  # 拡張子を除いたファイル名
-                    output_filename = f"{base_name}_buildings.geojson"
+                    output_filename = f"{base_name}_buildings.{OUTPUT_FORMATS[output_format][1]}"
                 else:
                     # 複数のファイルの場合
                     base_name = Path(uploaded_files[0].name).stem  # 最初のファイル名を使用
-                    output_filename = f"{base_name}_merged_buildings.geojson"
-                
-                # ダウンロードボタン
-                st.download_button(
-                    label="📥 GeoJSONファイルをダウンロード",
-                    data=geojson_json,
-                    file_name=output_filename,
-                    mime="application/geo+json",
-                    use_container_width=True
-                )
-                
-                # プレビュー表示（最初の10件のみ）
-                with st.expander("📋 変換結果のプレビュー（最初の10件）"):
-                    preview_features = all_features[:10]
-                    preview_geojson = {
-                        "type": "FeatureCollection",
-                        "features": preview_features
-                    }
-                    st.json(preview_geojson)
+                    output_filename = f"{base_name}_merged_buildings.{OUTPUT_FORMATS[output_format][1]}"
                 
+                # 変換結果を保存（ダウンロードボタンのクリックなどで再実行されても再変換しない）
+                st.session_state['result'] = {
+                    'total_files': total_files,
+                    'total_features': total_features,
+                    'output_format': output_format,
+                    'output_bytes': output_bytes,
+                    'output_filename': output_filename,
+                    'preview_json': preview_json,
+                }
             else:
+                st.session_state.pop('result', None)
                 st.warning("⚠️ 建物データが見つかりませんでした。ZIPファイルの内容を確認してください。")
+        
+        # 変換結果を表示
+        result = st.session_state.get('result')
+        if result:
+            show_result(result)
     
     else:
         st.info("👆 上記から基盤地図情報のZIPファイルをアップロードしてください")
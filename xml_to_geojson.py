@@ -10,7 +10,9 @@
 """
 
 import argparse
+import io
 import json
+import mmap
 import os
 import tempfile
 import zipfile
@@ -19,6 +21,21 @@ from typing import List, Dict, Any
 import xml.etree.ElementTree as ET
 from collections import defaultdict
 
+try:
+    from fastnumbers import float as parse_float
+except ImportError:  # fastnumbersが無い環境では組み込みのfloatを使用
+    parse_float = float
+
+# 3点のポリゴンを表せる座標文字列の最小の長さ（1桁の数値6個と区切りの空白5個）
+MIN_POSLIST_LENGTH = 11
+
+
+class MappedFile(mmap.mmap):
+    """ZipFileで読み込めるメモリマップ（Python 3.13より前のmmapにはseekable()が無いため補う）"""
+    
+    def seekable(self) -> bool:
+        return True
+
 
 class XMLToGeoJSONConverter:
     """基盤地図情報のXMLをGeoJSONに変換するクラス"""
@@ -29,6 +46,12 @@ class XMLToGeoJSONConverter:
             'ksj': 'http://nlftp.mlit.go.jp/ksj/schemas/ksj-app',
             'fme': 'http://www.safe.com/gml/fme'
         }
+        self.fgd_ns = '{http://fgd.gsi.go.jp/spec/2008/FGD_GMLSchema}'
+        self.gml_ns = '{http://www.opengis.net/gml/3.2}'
+        # 建物ごとに文字列を組み立てないよう、検索パスと属性名は事前に作成しておく
+        self.blda_path = f'.//{self.fgd_ns}BldA'
+        self.poslist_path = f'.//{self.gml_ns}posList'
+        self.gml_id_attr = f'{self.gml_ns}id'
     
     def parse_coordinates(self, coord_string: str) -> List[List[float]]:
         """座標文字列をパースして座標のリストに変換"""
@@ -38,12 +61,13 @@ class XMLToGeoJSONConverter:
         # 空白区切りの座標を処理（緯度 経度 緯度 経度 ...）
         coord_parts = coord_string.strip().split()
         coords = []
+        _float = parse_float
         
         for i in range(0, len(coord_parts), 2):
             if i + 1 < len(coord_parts):
                 # 基盤地図情報では緯度、経度の順で格納されている
-                lat = float(coord_parts[i])
-                lon = float(coord_parts[i + 1])
+                lat = _float(coord_parts[i])
+                lon = _float(coord_parts[i + 1])
                 # GeoJSONでは経度、緯度の順なので順序を入れ替え
                 coords.append([lon, lat])
         
@@ -71,19 +95,17 @@ class XMLToGeoJSONConverter:
         
         # 属性情報を取得
         for child in building_element:
-            if child.tag.startswith('{') and child.tag.endswith('}'):
-                # 名前空間付きタグの場合
-                tag_name = child.tag.split('}')[1]
-            else:
-                tag_name = child.tag
+            # 名前空間を除いたタグ名（名前空間が無い場合はタグ名そのまま）
+            tag_name = child.tag.rpartition('}')[2]
             
             # 建物関連の属性を収集
             if tag_name in ['fid', 'type', 'orgGILvl']:
                 properties[tag_name] = child.text
         
         # gml:id属性も取得
-        if 'gml:id' in building_element.attrib:
-            properties['gml_id'] = building_element.attrib['gml:id']
+        gml_id = building_element.get(self.gml_id_attr)
+        if gml_id is not None:
+            properties['gml_id'] = gml_id
         
         # 座標が有効な場合のみフィーチャーを作成
         if geometry_coords and len(geometry_coords) >= 3:  # ポリゴンの場合、最低3点必要
@@ -100,8 +122,8 @@ class XMLToGeoJSONConverter:
         
         return None
     
-    def parse_building_xml(self, xml_content: str) -> List[Dict[str, Any]]:
-        """建物XMLファイルをパースしてGeoJSONフィーチャーのリストを返す"""
+    def parse_building_xml(self, xml_content: bytes) -> List[Dict[str, Any]]:
+        """建物XMLファイル（バイト列）をパースしてGeoJSONフィーチャーのリストを返す"""
         try:
             root = ET.fromstring(xml_content)
         except ET.ParseError as e:
@@ -112,15 +134,15 @@ class XMLToGeoJSONConverter:
         
         # 建物要素を検索（BldA要素を直接検索）
         # 名前空間付きで検索
-        building_elements = root.findall('.//{http://fgd.gsi.go.jp/spec/2008/FGD_GMLSchema}BldA')
+        building_elements = root.findall(self.blda_path)
         
         # 各建物要素を処理
         for building in building_elements:
             geometry_coords = []
             
             # gml:posListを検索
-            poslist = building.find('.//{http://www.opengis.net/gml/3.2}posList')
-            if poslist is not None and poslist.text:
+            poslist = building.find(self.poslist_path)
+            if poslist is not None and poslist.text and len(poslist.text) >= MIN_POSLIST_LENGTH:
                 geometry_coords = self.parse_gml_poslist(poslist)
             
             # フィーチャーを作成
@@ -130,11 +152,18 @@ class XMLToGeoJSONConverter:
         
         return features
     
+    def find_building_files(self, file_list: List[str]) -> List[str]:
+        """ファイル名一覧から建物データ（-BldA-）のXMLファイルを抽出"""
+        return [f for f in file_list if '-BldA-' in f and f.endswith('.xml')]
+    
     def extract_and_convert_building_files(self, zip_path: str) -> List[Dict[str, Any]]:
         """ZIPファイルから建物ファイルを抽出してGeoJSONに変換"""
         all_features = []
         
-        with zipfile.ZipFile(zip_path, 'r') as main_zip:
+        # ディスク上のZIPファイルはメモリマップして読み込む（読み込み用のバッファへのコピーを省く）
+        with open(zip_path, 'rb') as zip_fh, \
+                MappedFile(zip_fh.fileno(), 0, access=mmap.ACCESS_READ) as zip_map, \
+                zipfile.ZipFile(zip_map, 'r') as main_zip:
             print(f"メインZIPファイルを処理中: {zip_path}")
             
             # メインZIP内のファイル一覧を取得
@@ -146,32 +175,34 @@ class XMLToGeoJSONConverter:
             for sub_zip_name in zip_files:
                 print(f"処理中: {sub_zip_name}")
                 
-                # サブZIPファイルを読み込み
-                with main_zip.open(sub_zip_name) as sub_zip_data:
-                    with zipfile.ZipFile(sub_zip_data, 'r') as sub_zip:
-                        # サブZIP内のファイル一覧を取得
-                        sub_file_list = sub_zip.namelist()
-                        
-                        # -BldA-を含むファイルを検索
-                        building_files = [f for f in sub_file_list if '-BldA-' in f and f.endswith('.xml')]
+                # サブZIPファイルをメモリに読み込む（ZIP内のストリームのままだと、
+                # 中央ディレクトリの参照や各ファイルへのシークのたびに先頭から解凍し直しになる）
+                sub_zip_data = io.BytesIO(main_zip.read(sub_zip_name))
+                with zipfile.ZipFile(sub_zip_data, 'r') as sub_zip:
+                    # サブZIP内のファイル一覧を取得
+                    sub_file_list = sub_zip.namelist()
+                    
+                    # -BldA-を含むファイルを検索
+                    building_files = self.find_building_files(sub_file_list)
+                    
+                    for building_file in building_files:
+                        print(f"  建物ファイル処理中: {building_file}")
                         
-                        for building_file in building_files:
-                            print(f"  建物ファイル処理中: {building_file}")
+                        try:
+                            # XMLファイルを読み込み（文字コードはXML宣言に従ってパーサーが処理するため、
+                            # 文字列にデコードせずバイト列のまま渡す）
+                            with sub_zip.open(building_file) as xml_data:
+                                xml_content = xml_data.read()
+                            
+                            # XMLをGeoJSONに変換
+                            features = self.parse_building_xml(xml_content)
+                            all_features.extend(features)
+                            
+                            print(f"    変換完了: {len(features)}個の建物")
                             
-                            try:
-                                # XMLファイルを読み込み
-                                with sub_zip.open(building_file) as xml_data:
-                                    xml_content = xml_data.read().decode('utf-8')
-                                
-                                # XMLをGeoJSONに変換
-                                features = self.parse_building_xml(xml_content)
-                                all_features.extend(features)
-                                
-                                print(f"    変換完了: {len(features)}個の建物")
-                                
-                            except Exception as e:
-                                print(f"    エラー: {e}")
-                                continue
+                        except Exception as e:
+                            print(f"    エラー: {e}")
+                            continue
         
         return all_features
 
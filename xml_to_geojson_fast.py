@@ -10,13 +10,63 @@
 """
 
 import argparse
+import io
 import json
 import os
+import warnings
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
 import xml.etree.ElementTree as ET
 
+try:
+    import numpy as np
+except ImportError:  # NumPyが無い環境では純Pythonで座標をパース
+    np = None
+
+try:
+    from fastnumbers import float as parse_float
+except ImportError:  # fastnumbersが無い環境では組み込みのfloatを使用
+    parse_float = float
+
+try:
+    import orjson
+except ImportError:  # orjsonが無い環境では標準ライブラリのjsonを使用
+    orjson = None
+
+try:
+    from lxml import etree as LET
+except ImportError:  # lxmlが無い環境では標準ライブラリのパーサーを使用
+    LET = None
+
+# パースエラーとして扱う例外
+XML_PARSE_ERRORS = (ET.ParseError,) if LET is None else (ET.ParseError, LET.XMLSyntaxError)
+
+# 座標（(N, 2)のNumPy配列、またはNumPyが無い場合は[経度, 緯度]のリスト）
+Coordinates = Union['np.ndarray', List[List[float]]]
+# 座標をまとめてパースする建物の件数
+COORDINATE_BATCH_SIZE = 1000
+# 3点のポリゴンを表せる座標文字列の最小の長さ（1桁の数値6個と区切りの空白5個）
+MIN_POSLIST_LENGTH = 11
+
+
+class BuildingFeature(NamedTuple):
+    """建物フィーチャー（座標と属性）
+    
+    建物ごとにdictを持つとメモリ消費が大きいため、GeoJSONへの変換は出力時に行う
+    """
+    coords: Coordinates
+    fid: Optional[str] = None
+    type: Optional[str] = None
+    orgGILvl: Optional[str] = None
+    gml_id: Optional[str] = None
+
+
+# 出力するプロパティ名（出力順）
+PROPERTY_NAMES = BuildingFeature._fields[1:]
+
 
 class FastXMLToGeoJSONConverter:
     """基盤地図情報のXMLを高速でGeoJSONに変換するクラス"""
@@ -24,87 +74,219 @@ class FastXMLToGeoJSONConverter:
     def __init__(self):
         self.fgd_ns = '{http://fgd.gsi.go.jp/spec/2008/FGD_GMLSchema}'
         self.gml_ns = '{http://www.opengis.net/gml/3.2}'
+        self.blda_tag = f'{self.fgd_ns}BldA'
+        self.poslist_tag = f'{self.gml_ns}posList'
+        # 取得する属性の名前空間付きタグと、出力するプロパティ名の対応
+        self.property_tags = {
+            f'{self.fgd_ns}fid': 'fid',
+            f'{self.fgd_ns}type': 'type',
+            f'{self.fgd_ns}orgGILvl': 'orgGILvl',
+        }
+        self.gml_id_attr = f'{self.gml_ns}id'
+        # 種別（type）や精度（orgGILvl）は値の種類が少ないため、同じ値の文字列を共有する
+        self.shared_values = {}
     
-    def parse_coordinates(self, coord_string: str) -> List[List[float]]:
-        """座標文字列をパースして座標のリストに変換"""
+    def parse_coordinates(self, coord_string: str) -> Coordinates:
+        """座標文字列をパースして座標の配列（NumPyが無い場合はリスト）に変換"""
         if not coord_string:
             return []
         
+        if np is not None:
+            # NumPyで一括パース（緯度 経度 緯度 経度 ...）
+            # （np.fromstringはNumPy 1.xでは不正な値の手前で打ち切るだけなので、分割してから変換する）
+            values = np.array(coord_string.split(), dtype=np.float64)
+            if values.size < 6 or values.size % 2:  # ポリゴンの場合、最低3点必要
+                return []
+            # GeoJSONでは経度、緯度の順なので列を入れ替え（C連続の配列としてコピー）
+            return values.reshape(-1, 2)[:, ::-1].copy()
+        
         # 空白区切りの座標を処理（緯度 経度 緯度 経度 ...）
         coord_parts = coord_string.strip().split()
         coords = []
+        _float = parse_float
         
         for i in range(0, len(coord_parts), 2):
             if i + 1 < len(coord_parts):
                 # 基盤地図情報では緯度、経度の順で格納されている
-                lat = float(coord_parts[i])
-                lon = float(coord_parts[i + 1])
+                lat = _float(coord_parts[i])
+                lon = _float(coord_parts[i + 1])
                 # GeoJSONでは経度、緯度の順なので順序を入れ替え
                 coords.append([lon, lat])
         
         return coords
     
-    def parse_building_xml(self, xml_content: str) -> List[Dict[str, Any]]:
-        """建物XMLファイルをパースしてGeoJSONフィーチャーのリストを返す"""
+    def parse_coordinates_each(self, coord_strings: List[str]) -> List[Coordinates]:
+        """座標文字列を1件ずつパース（不正な値を含む建物のみ空の座標とし、他の建物には影響させない）"""
+        coords_list = []
+        for coord_string in coord_strings:
+            try:
+                coords_list.append(self.parse_coordinates(coord_string))
+            except ValueError:
+                coords_list.append([])
+        return coords_list
+    
+    def parse_coordinates_batch(self, coord_strings: List[str]) -> List[Coordinates]:
+        """複数の座標文字列をまとめてパースし、それぞれの座標配列のリストを返す
+        
+        建物ごとにNumPyを呼び出すと、頂点数の少ないポリゴンでは呼び出しのオーバーヘッドが
+        パース自体より大きくなるため、連結して1回の呼び出しでパースする
+        """
+        if np is None:
+            return self.parse_coordinates_each(coord_strings)
+        
+        # 建物ごとの座標文字列をNaNで区切って連結し、一括でパース
+        # 不正な値を含む場合、NumPy 2.xでは例外になるが、NumPy 1.xでは警告のみで
+        # その手前でパースが打ち切られるため、警告も例外として扱い1件ずつパースし直す
         try:
-            root = ET.fromstring(xml_content)
-        except ET.ParseError as e:
-            print(f"XMLパースエラー: {e}")
-            return []
+            with warnings.catch_warnings():
+                warnings.simplefilter('error', DeprecationWarning)
+                values = np.fromstring(' nan '.join(coord_strings), dtype=np.float64, sep=' ')
+        except (ValueError, DeprecationWarning):
+            return self.parse_coordinates_each(coord_strings)
+        ends = np.flatnonzero(np.isnan(values)).tolist()
+        ends.append(values.size)
         
-        features = []
+        # 座標文字列中のnanでも区切りがずれるため、区切りの数が合わない場合は1件ずつパースし直す
+        if len(ends) != len(coord_strings):
+            return self.parse_coordinates_each(coord_strings)
         
-        # 建物要素を検索（名前空間付きで検索）
-        building_elements = root.findall(f'.//{self.fgd_ns}BldA')
+        coords_list = []
+        start = 0
+        for end in ends:
+            size = end - start
+            if size < 6 or size % 2:  # ポリゴンの場合、最低3点必要
+                coords_list.append([])
+            else:
+                # GeoJSONでは経度、緯度の順なので列を入れ替え（C連続の配列としてコピー）
+                coords_list.append(values[start:end].reshape(-1, 2)[:, ::-1].copy())
+            start = end + 1
         
-        print(f"  見つかった建物要素数: {len(building_elements)}")
+        return coords_list
+    
+    def complete_features(self, pending: List[Tuple[Dict[str, Any], str]]) -> Iterator[BuildingFeature]:
+        """パース待ちの建物の座標をまとめてパースし、有効なポリゴンの建物フィーチャーを返す"""
+        coords_list = self.parse_coordinates_batch([coord_string for _, coord_string in pending])
+        for (properties, _), coords in zip(pending, coords_list):
+            if len(coords) >= 3:  # ポリゴンの場合、最低3点必要
+                yield BuildingFeature(coords, **properties)
+    
+    def iter_buildings(self, source):
+        """XMLを逐次パースしてBldA要素を順に返す（処理済みの要素はメモリから解放）"""
+        if LET is not None:
+            # 不正な箇所があっても例外で中断せず、読み取れた建物要素は処理を続ける
+            # IDの収集や空白のみのテキストは不要なため省き、巨大なファイルも制限なしで読み込む
+            # （外部の実体参照やネットワークへのアクセスは行わない）
+            context = LET.iterparse(
+                source, events=('end',), tag=self.blda_tag, recover=True,
+                collect_ids=False, remove_blank_text=True, huge_tree=True,
+                resolve_entities=False, no_network=True,
+            )
+            for _, building in context:
+                yield building
+                # 処理済みの建物要素と、それより前の兄弟要素を削除
+                building.clear(keep_tail=True)
+                while building.getprevious() is not None:
+                    del building.getparent()[0]
+            
+            # 読み飛ばしたエラーがあれば最初の1件を報告
+            errors = context.error_log.filter_from_errors()
+            if errors:
+                print(f"    XMLパースエラー（読み飛ばして続行）: {errors[0].message} (line {errors[0].line})")
+        else:
+            context = ET.iterparse(source, events=('start', 'end'))
+            _, root = next(context)
+            for event, elem in context:
+                if event == 'end' and elem.tag == self.blda_tag:
+                    yield elem
+                    # 処理済みの要素をルートから削除
+                    root.clear()
+    
+    def iter_building_features(self, xml_file) -> Iterator[BuildingFeature]:
+        """建物XMLファイルを逐次パースして建物フィーチャー（プロパティ, 座標）を順に返す"""
+        poslist_tag = self.poslist_tag
+        property_tags = self.property_tags
+        shared_values = self.shared_values
+        pending = []  # 座標のパース待ちの建物（プロパティ, 座標文字列）
         
-        # 各建物要素を処理
-        for i, building in enumerate(building_elements):
-            if i % 1000 == 0 and i > 0:
-                print(f"    処理中: {i}/{len(building_elements)}")
+        try:
+            # 各建物要素を処理
+            for i, building in enumerate(self.iter_buildings(xml_file)):
+                if i % 1000 == 0 and i > 0:
+                    print(f"    処理中: {i}")
+                
+                # 座標を取得
+                poslist = next(building.iter(poslist_tag), None)
+                if poslist is None:
+                    continue
+                coord_string = poslist.text
+                if not coord_string or len(coord_string) < MIN_POSLIST_LENGTH:  # 空・3点未満は明らかに無効
+                    continue
+                
+                # 属性情報を取得
+                properties = {}
+                
+                # 属性情報を取得
+                for child in building:
+                    name = property_tags.get(child.tag)
+                    if name is not None:
+                        text = child.text
+                        if name != 'fid':  # fidは建物ごとに異なるため共有しない
+                            text = shared_values.setdefault(text, text)
+                        properties[name] = text
+                
+                # gml:id属性も取得
+                gml_id = building.get(self.gml_id_attr)
+                if gml_id is not None:
+                    properties['gml_id'] = gml_id
+                
+                # 座標は一定件数ごとにまとめてパース
+                pending.append((properties, coord_string))
+                if len(pending) >= COORDINATE_BATCH_SIZE:
+                    yield from self.complete_features(pending)
+                    pending = []
+        except XML_PARSE_ERRORS as e:
+            print(f"XMLパースエラー: {e}")
+        
+        # 残りの建物の座標をパース
+        yield from self.complete_features(pending)
+    
+    def find_building_files(self, file_list: List[str]) -> List[str]:
+        """ファイル名一覧から建物データ（-BldA-）のXMLファイルを抽出"""
+        return [f for f in file_list if '-BldA-' in f and f.endswith('.xml')]
+    
+    def convert_sub_zip(self, main_zip: zipfile.ZipFile, sub_zip_name: str) -> List[BuildingFeature]:
+        """サブZIPファイル内の建物ファイルを建物フィーチャーに変換"""
+        features = []
+        
+        # サブZIPファイルをメモリに読み込む（ZIP内のストリームのままだと、
+        # 中央ディレクトリの参照や各ファイルへのシークのたびに先頭から解凍し直しになる）
+        sub_zip_data = io.BytesIO(main_zip.read(sub_zip_name))
+        with zipfile.ZipFile(sub_zip_data, 'r') as sub_zip:
+            # サブZIP内のファイル一覧を取得
+            sub_file_list = sub_zip.namelist()
             
-            # 座標を取得
-            poslist = building.find(f'.//{self.gml_ns}posList')
-            if poslist is not None and poslist.text:
-                coords = self.parse_coordinates(poslist.text)
+            # -BldA-を含むファイルを検索
+            building_files = self.find_building_files(sub_file_list)
+            
+            for building_file in building_files:
+                print(f"  建物ファイル処理中: {building_file}")
                 
-                if len(coords) >= 3:  # ポリゴンの場合、最低3点必要
-                    # 属性情報を取得
-                    properties = {}
-                    
-                    # 属性情報を取得
-                    for child in building:
-                        if child.tag.startswith('{') and child.tag.endswith('}'):
-                            tag_name = child.tag.split('}')[1]
-                        else:
-                            tag_name = child.tag
-                        
-                        if tag_name in ['fid', 'type', 'orgGILvl']:
-                            properties[tag_name] = child.text
-                    
-                    # gml:id属性も取得
-                    if 'gml:id' in building.attrib:
-                        properties['gml_id'] = building.attrib['gml:id']
+                try:
+                    # XMLファイルを逐次読み込みながらGeoJSONに変換
+                    count = len(features)
+                    with sub_zip.open(building_file) as xml_data:
+                        features.extend(self.iter_building_features(xml_data))
                     
-                    # フィーチャーを作成
-                    feature = {
-                        "type": "Feature",
-                        "geometry": {
-                            "type": "Polygon",
-                            "coordinates": [coords]
-                        },
-                        "properties": properties
-                    }
+                    print(f"    変換完了: {len(features) - count}個の建物")
                     
-                    features.append(feature)
+                except Exception as e:
+                    print(f"    エラー: {e}")
+                    continue
         
         return features
     
-    def extract_and_convert_building_files(self, zip_path: str, max_files: int = None) -> List[Dict[str, Any]]:
-        """ZIPファイルから建物ファイルを抽出してGeoJSONに変換"""
-        all_features = []
-        
+    def extract_and_convert_building_files(self, zip_path: str, max_files: int = None) -> Iterator[BuildingFeature]:
+        """ZIPファイルから建物ファイルを抽出し、建物フィーチャーを順に返す"""
         with zipfile.ZipFile(zip_path, 'r') as main_zip:
             print(f"メインZIPファイルを処理中: {zip_path}")
             
@@ -117,37 +299,60 @@ class FastXMLToGeoJSONConverter:
             
             print(f"処理するサブZIPファイル数: {len(zip_files)}")
             
-            for i, sub_zip_name in enumerate(zip_files):
+            if not zip_files:
+                return
+            
+            def convert(args):
+                i, sub_zip_name = args
                 print(f"処理中 ({i+1}/{len(zip_files)}): {sub_zip_name}")
-                
-                # サブZIPファイルを読み込み
-                with main_zip.open(sub_zip_name) as sub_zip_data:
-                    with zipfile.ZipFile(sub_zip_data, 'r') as sub_zip:
-                        # サブZIP内のファイル一覧を取得
-                        sub_file_list = sub_zip.namelist()
-                        
-                        # -BldA-を含むファイルを検索
-                        building_files = [f for f in sub_file_list if '-BldA-' in f and f.endswith('.xml')]
-                        
-                        for building_file in building_files:
-                            print(f"  建物ファイル処理中: {building_file}")
-                            
-                            try:
-                                # XMLファイルを読み込み
-                                with sub_zip.open(building_file) as xml_data:
-                                    xml_content = xml_data.read().decode('utf-8')
-                                
-                                # XMLをGeoJSONに変換
-                                features = self.parse_building_xml(xml_content)
-                                all_features.extend(features)
-                                
-                                print(f"    変換完了: {len(features)}個の建物")
-                                
-                            except Exception as e:
-                                print(f"    エラー: {e}")
-                                continue
-        
-        return all_features
+                return self.convert_sub_zip(main_zip, sub_zip_name)
+            
+            # サブZIPファイルを複数スレッドで並列に処理（解凍中はGILが解放される）
+            max_workers = min(len(zip_files), os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # 結果はサブZIPファイルの順序どおりに、変換が終わったものから返す
+                for features in executor.map(convert, enumerate(zip_files)):
+                    yield from features
+
+
+def to_geojson_feature(feature: BuildingFeature) -> Dict[str, Any]:
+    """建物フィーチャーからGeoJSONフィーチャーを作成（値の無い属性は出力しない）"""
+    properties = {name: value for name, value in zip(PROPERTY_NAMES, feature[1:]) if value is not None}
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [feature.coords]
+        },
+        "properties": properties
+    }
+
+
+def _json_default(obj):
+    """NumPy配列をJSONに変換できるリストに変換"""
+    if np is not None and isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_feature(feature: Dict[str, Any]) -> bytes:
+    """GeoJSONフィーチャーをUTF-8のJSONバイト列に変換"""
+    if orjson is not None:
+        return orjson.dumps(feature, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(feature, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+
+def write_geojson(features: Iterable[BuildingFeature], f) -> int:
+    """建物フィーチャーを1件ずつGeoJSON（FeatureCollection）としてバイナリファイルに書き出し、件数を返す"""
+    count = 0
+    f.write(b'{"type": "FeatureCollection", "features": [\n')
+    for feature in features:
+        if count:
+            f.write(b',\n')
+        f.write(dumps_feature(to_geojson_feature(feature)))
+        count += 1
+    f.write(b'\n]}\n')
+    return count
 
 
 def main():
@@ -167,24 +372,20 @@ def main():
     converter = FastXMLToGeoJSONConverter()
     features = converter.extract_and_convert_building_files(args.zip_file, args.max_files)
     
-    if not features:
+    # 最初のフィーチャーが得られるまで変換してから出力ファイルを作成
+    first_feature = next(features, None)
+    if first_feature is None:
         print("建物データが見つかりませんでした。")
         return 1
     
-    # GeoJSONファイルを作成
-    geojson_data = {
-        "type": "FeatureCollection",
-        "features": features
-    }
-    
-    # ファイルに出力
+    # GeoJSONファイルに出力（変換済みのフィーチャーから順に書き出し）
     print(f"GeoJSONファイルに出力中: {args.output}")
-    with open(args.output, 'w', encoding='utf-8') as f:
-        json.dump(geojson_data, f, ensure_ascii=False, indent=2)
+    with open(args.output, 'wb') as f:
+        count = write_geojson(chain([first_feature], features), f)
     
     print(f"変換完了!")
     print(f"出力ファイル: {args.output}")
-    print(f"建物数: {len(features)}")
+    print(f"建物数: {count}")
     
     return 0
 
@@ -10,111 +10,244 @@
 """
 
 import argparse
+import hashlib
+import io
 import os
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Tuple
 import xml.etree.ElementTree as ET
-import geopandas as gpd
-from shapely.geometry import Polygon
-import pandas as pd
+import numpy as np
+
+# GeoPandas・Shapelyは読み込みに時間がかかるため、ジオメトリを作成・出力する時点で読み込む
+# （XMLをパースするワーカープロセスではNumPyとlxmlのみを使用する）
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+try:
+    import orjson
+except ImportError:  # orjsonが無い環境ではGDAL経由でGeoJSONを書き出し
+    orjson = None
+
+try:
+    from tqdm import tqdm
+except ImportError:  # tqdmが無い環境ではサブZIPファイルごとに進捗を表示
+    tqdm = None
+
+try:
+    from lxml import etree as LET
+except ImportError:  # lxmlが無い環境では標準ライブラリのパーサーを使用
+    LET = None
+
+# パースエラーとして扱う例外
+XML_PARSE_ERRORS = (ET.ParseError,) if LET is None else (ET.ParseError, LET.XMLSyntaxError)
+
+FGD_NS = '{http://fgd.gsi.go.jp/spec/2008/FGD_GMLSchema}'
+GML_NS = '{http://www.opengis.net/gml/3.2}'
+
+# 基盤地図情報の座標（経度・緯度）の座標参照系
+# 変換結果全体で一度だけGeoDataFrameを作成するため、CRSの解釈も一度だけ行われる
+SOURCE_CRS = 'EPSG:4326'
+
+# 座標の精度（コマンドライン引数の値: 座標を保持するNumPyの型）
+# f32はメモリ使用量とプロセス間の転送量が半分になるが、精度は約1m（10進で7桁程度）になる
+# （Shapelyのジオメトリ作成時には倍精度に変換される）
+COORD_DTYPES = {'f64': np.float64, 'f32': np.float32}
+
+# 出力する属性名（建物データの列）
+PROPERTY_NAMES = ['fid', 'type', 'orgGILvl', 'gml_id']
+# 子要素から取得する属性名と、名前空間付きのタグ
+PROPERTY_TAGS = [
+    ('fid', f'{FGD_NS}fid'),
+    ('type', f'{FGD_NS}type'),
+    ('orgGILvl', f'{FGD_NS}orgGILvl'),
+]
+GML_ID_ATTR = f'{GML_NS}id'
+BLDA_TAG = f'{FGD_NS}BldA'
+# posListは建物要素の数階層下にあるが、面の表現（Ring/curveMember等）によって階層が異なるため
+# パスは固定せず、タグ名で子孫要素を検索する（パス文字列の解釈も不要）
+POSLIST_TAG = f'{GML_NS}posList'
 
 
 class XMLToGeoJSONConverterGPD:
     """基盤地図情報のXMLをGeoPandasを使用してGeoJSONに変換するクラス"""
     
-    def __init__(self):
+    def __init__(self, precision: str = 'f64', drop_duplicates: bool = True):
         self.namespaces = {
             'gml': 'http://www.opengis.net/gml/3.2',
             'fgd': 'http://fgd.gsi.go.jp/spec/2008/FGD_GMLSchema'
         }
+        self.precision = precision
+        self.coord_dtype = COORD_DTYPES[precision]
+        # 図郭の境界で複数のXMLファイルに含まれる同じ建物を除外するか
+        self.drop_duplicates = drop_duplicates
     
-    def parse_coordinates(self, coord_string: str) -> List[List[float]]:
-        """座標文字列をパースして座標のリストに変換"""
+    def parse_coordinates(self, coord_string: str) -> Optional[np.ndarray]:
+        """座標文字列をパースして(N, 2)の座標配列に変換（ポリゴンにならない場合はNone）"""
         if not coord_string:
-            return []
-        
-        # 空白区切りの座標を処理（緯度 経度 緯度 経度 ...）
-        coord_parts = coord_string.strip().split()
-        coords = []
+            return None
         
-        for i in range(0, len(coord_parts), 2):
-            if i + 1 < len(coord_parts):
-                # 基盤地図情報では緯度、経度の順で格納されている
-                lat = float(coord_parts[i])
-                lon = float(coord_parts[i + 1])
-                # GeoJSONでは経度、緯度の順なので順序を入れ替え
-                coords.append([lon, lat])
+        # NumPyで一括パース（緯度 経度 緯度 経度 ...）
+        # （np.fromstringはNumPy 1.xでは不正な値の手前で打ち切るだけなので、分割してから変換する）
+        values = np.array(coord_string.split(), dtype=self.coord_dtype)
+        if values.size < 6 or values.size % 2:  # ポリゴンの場合、最低3点必要
+            return None
         
-        return coords
+        # 基盤地図情報では緯度、経度の順で格納されている
+        # GeoJSONでは経度、緯度の順なので列を入れ替え
+        # （コピーを伴わないビューで入れ替えるため、頂点ごとのPython処理は不要。
+        # 座標変換が必要な場合もtransform_coordinatesで全建物の配列をまとめて変換する）
+        return values.reshape(-1, 2)[:, ::-1]
+    
+    def iter_buildings(self, source):
+        """XMLを逐次パースしてBldA要素を順に返す（処理済みの要素はメモリから解放）"""
+        if LET is not None:
+            # 不正な箇所があっても例外で中断せず、読み取れた建物要素は処理を続ける
+            context = LET.iterparse(
+                source, events=('end',), tag=BLDA_TAG, recover=True,
+                collect_ids=False, remove_blank_text=True, huge_tree=True,
+                resolve_entities=False, no_network=True,
+            )
+            for _, building in context:
+                yield building
+                # 処理済みの建物要素と、それより前の兄弟要素を削除
+                building.clear(keep_tail=True)
+                while building.getprevious() is not None:
+                    del building.getparent()[0]
+            
+            # 読み飛ばしたエラーがあれば最初の1件を報告
+            errors = context.error_log.filter_from_errors()
+            if errors:
+                print(f"    XMLパースエラー（読み飛ばして続行）: {errors[0].message} (line {errors[0].line})")
+        else:
+            context = ET.iterparse(source, events=('start', 'end'))
+            _, root = next(context)
+            for event, elem in context:
+                if event == 'end' and elem.tag == BLDA_TAG:
+                    yield elem
+                    # 処理済みの要素をルートから削除
+                    root.clear()
     
-    def parse_building_xml(self, xml_content: str) -> gpd.GeoDataFrame:
-        """建物XMLファイルをパースしてGeoDataFrameを返す"""
+    def parse_building_xml(self, xml_file) -> Dict[str, Any]:
+        """建物XMLファイルを逐次パースして建物データを返す
+        
+        戻り値は属性の列（fid、type、orgGILvl、gml_id）に加えて、全建物の頂点を連結した
+        (M, 2)の座標配列'coords'と建物ごとの頂点数'sizes'を持つdict
+        （ワーカープロセスから転送しやすいよう、Shapelyのジオメトリは作成しない）
+        """
+        # 属性は列ごとのリストに蓄積（建物ごとのdictは作らない）
+        columns = {name: [] for name in PROPERTY_NAMES}
+        coord_arrays = []  # 建物ごとの(N, 2)の座標配列（ポリゴンはまとめて作成）
+        
         try:
-            root = ET.fromstring(xml_content)
-        except ET.ParseError as e:
+            # 各建物要素を処理
+            for building in self.iter_buildings(xml_file):
+                # 座標を取得
+                poslist = next(building.iter(POSLIST_TAG), None)
+                if poslist is not None and poslist.text:
+                    coords = self.parse_coordinates(poslist.text)
+                    
+                    if coords is not None:
+                        # 属性情報を取得（無い場合はNone）
+                        for name, tag in PROPERTY_TAGS:
+                            element = building.find(tag)
+                            columns[name].append(element.text if element is not None else None)
+                        
+                        # gml:id属性も取得（属性名は名前空間付きで格納されている）
+                        columns['gml_id'].append(building.get(GML_ID_ATTR))
+                        
+                        coord_arrays.append(coords)
+        except XML_PARSE_ERRORS as e:
             print(f"XMLパースエラー: {e}")
-            return gpd.GeoDataFrame()
         
-        buildings_data = []
+        columns['coords'] = np.concatenate(coord_arrays) if coord_arrays else np.empty((0, 2), dtype=self.coord_dtype)
+        columns['sizes'] = np.array([len(coords) for coords in coord_arrays], dtype=np.int64)
+        return columns
+    
+    def transform_coordinates(self, coords: np.ndarray, target_crs: str) -> np.ndarray:
+        """全建物の(M, 2)の座標配列を、指定の座標参照系にまとめて変換"""
+        # pyprojはgeopandasの依存関係として導入済み（座標変換を行う場合のみ読み込む）
+        from pyproj import Transformer
         
-        # 建物要素を検索（名前空間付きで検索）
-        building_elements = root.findall('.//{http://fgd.gsi.go.jp/spec/2008/FGD_GMLSchema}BldA')
+        transformer = Transformer.from_crs(SOURCE_CRS, target_crs, always_xy=True)
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack((x, y))
+    
+    def to_geodataframe(self, building_data: Dict[str, Any], target_crs: str = None) -> 'gpd.GeoDataFrame':
+        """建物データからGeoDataFrameを作成（全ファイルの建物データを結合した後に一度だけ呼び出す）
         
-        print(f"  見つかった建物要素数: {len(building_elements)}")
+        target_crsを指定した場合は、ポリゴンを作成する前に座標を変換する
+        """
+        import geopandas as gpd
+        import shapely
         
-        # 各建物要素を処理
-        for i, building in enumerate(building_elements):
-            if i % 1000 == 0 and i > 0:
-                print(f"    処理中: {i}/{len(building_elements)}")
-            
-            # 座標を取得
-            poslist = building.find('.//{http://www.opengis.net/gml/3.2}posList')
-            if poslist is not None and poslist.text:
-                coords = self.parse_coordinates(poslist.text)
-                
-                if len(coords) >= 3:  # ポリゴンの場合、最低3点必要
-                    try:
-                        # ShapelyのPolygonオブジェクトを作成
-                        polygon = Polygon(coords)
-                        
-                        # 属性情報を取得
-                        properties = {}
-                        
-                        # 属性情報を取得
-                        for child in building:
-                            if child.tag.startswith('{') and child.tag.endswith('}'):
-                                tag_name = child.tag.split('}')[1]
-                            else:
-                                tag_name = child.tag
-                            
-                            if tag_name in ['fid', 'type', 'orgGILvl']:
-                                properties[tag_name] = child.text
-                        
-                        # gml:id属性も取得
-                        if 'gml:id' in building.attrib:
-                            properties['gml_id'] = building.attrib['gml:id']
-                        
-                        # データをリストに追加
-                        buildings_data.append({
-                            'geometry': polygon,
-                            **properties
-                        })
-                        
-                    except Exception as e:
-                        print(f"    ポリゴン作成エラー: {e}")
-                        continue
-        
-        if buildings_data:
-            # GeoDataFrameを作成
-            gdf = gpd.GeoDataFrame(buildings_data, crs='EPSG:4326')
-            return gdf
-        else:
-            return gpd.GeoDataFrame()
+        coords = building_data['coords']
+        crs = SOURCE_CRS
+        if target_crs:
+            coords = self.transform_coordinates(coords, target_crs)
+            crs = target_crs
+        
+        # 各建物を外周リング1つのポリゴンとして、連結した座標配列から一括でPolygonを作成
+        sizes = building_data['sizes']
+        ring_offsets = np.concatenate(([0], np.cumsum(sizes)))
+        polygon_offsets = np.arange(len(sizes) + 1)
+        polygons = shapely.from_ragged_array(shapely.GeometryType.POLYGON, coords, (ring_offsets, polygon_offsets))
+        
+        columns = {name: building_data[name] for name in PROPERTY_NAMES}
+        return gpd.GeoDataFrame(columns, geometry=polygons, crs=crs)
+    
+    def find_building_files(self, file_list: List[str]) -> List[str]:
+        """ファイル名一覧から建物データ（-BldA-）のXMLファイルを抽出"""
+        return [f for f in file_list if '-BldA-' in f and f.endswith('.xml')]
     
-    def extract_and_convert_building_files(self, zip_path: str, max_files: int = None) -> gpd.GeoDataFrame:
-        """ZIPファイルから建物ファイルを抽出してGeoDataFrameに変換"""
-        all_gdfs = []
+    def merge_building_data(self, building_data_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """複数の建物データを列ごとに連結して1つの建物データにする"""
+        merged = {
+            name: list(chain.from_iterable(building_data[name] for building_data in building_data_list))
+            for name in PROPERTY_NAMES
+        }
+        merged['coords'] = np.concatenate([building_data['coords'] for building_data in building_data_list])
+        merged['sizes'] = np.concatenate([building_data['sizes'] for building_data in building_data_list])
+        return merged
+    
+    def drop_duplicate_buildings(self, building_data: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+        """重複する建物を除いた建物データと、除外した件数を返す
+        
+        同じfidの建物（fidが無い場合は座標が完全に一致する建物）は、最初の1件のみを残す
+        """
+        coords = building_data['coords']
+        sizes = building_data['sizes']
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        
+        seen = set()
+        keep = np.ones(len(sizes), dtype=bool)
+        for i, fid in enumerate(building_data['fid']):
+            if fid is not None:
+                key = fid
+            else:
+                key = hashlib.blake2b(coords[offsets[i]:offsets[i + 1]].tobytes(), digest_size=16).digest()
+            if key in seen:
+                keep[i] = False
+            else:
+                seen.add(key)
+        
+        removed = len(sizes) - int(keep.sum())
+        if not removed:
+            return building_data, 0
+        
+        deduplicated = {
+            name: [value for value, kept in zip(building_data[name], keep) if kept]
+            for name in PROPERTY_NAMES
+        }
+        deduplicated['coords'] = coords[np.repeat(keep, sizes)]
+        deduplicated['sizes'] = sizes[keep]
+        return deduplicated, removed
+    
+    def extract_and_convert_building_files(self, zip_path: str, max_files: int = None, target_crs: str = None) -> Optional['gpd.GeoDataFrame']:
+        """ZIPファイルから建物ファイルを抽出してGeoDataFrameに変換（target_crsを指定した場合は座標を変換）"""
+        all_building_data = []
         
         with zipfile.ZipFile(zip_path, 'r') as main_zip:
             print(f"メインZIPファイルを処理中: {zip_path}")
@@ -128,45 +261,113 @@ class XMLToGeoJSONConverterGPD:
             
             print(f"処理するサブZIPファイル数: {len(zip_files)}")
             
-            for i, sub_zip_name in enumerate(zip_files):
-                print(f"処理中 ({i+1}/{len(zip_files)}): {sub_zip_name}")
+        # サブZIPファイルごとに別プロセスで並列にパース
+        # （各ワーカーが自身でメインZIPファイルを開き、担当するサブZIPファイルだけを展開する）
+        # （ワーカーはサブZIPファイル数までしか起動しない。ProcessPoolExecutorは0を受け付けないため最低1）
+        max_workers = max(1, min(len(zip_files), os.cpu_count() or 1))
+        # 各ワーカーに数回に分けて割り当て、プロセス間通信の回数を抑えつつ負荷を均等にする
+        chunksize = max(1, len(zip_files) // (4 * max_workers))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(zip_path, self.precision)) as executor:
+            results = zip(zip_files, executor.map(_parse_sub_zip, zip_files, chunksize=chunksize))
+            if tqdm is not None:
+                results = tqdm(results, total=len(zip_files), desc="サブZIPファイル", unit="件")
+            
+            for i, (sub_zip_name, sub_zip_results) in enumerate(results, start=1):
+                building_count = 0
+                for building_data in sub_zip_results:
+                    if len(building_data['sizes']):
+                        all_building_data.append(building_data)
+                        building_count += len(building_data['sizes'])
                 
-                # サブZIPファイルを読み込み
-                with main_zip.open(sub_zip_name) as sub_zip_data:
-                    with zipfile.ZipFile(sub_zip_data, 'r') as sub_zip:
-                        # サブZIP内のファイル一覧を取得
-                        sub_file_list = sub_zip.namelist()
-                        
-                        # -BldA-を含むファイルを検索
-                        building_files = [f for f in sub_file_list if '-BldA-' in f and f.endswith('.xml')]
-                        
-                        for building_file in building_files:
-                            print(f"  建物ファイル処理中: {building_file}")
-                            
-                            try:
-                                # XMLファイルを読み込み
-                                with sub_zip.open(building_file) as xml_data:
-                                    xml_content = xml_data.read().decode('utf-8')
-                                
-                                # XMLをGeoDataFrameに変換
-                                gdf = self.parse_building_xml(xml_content)
-                                
-                                if not gdf.empty:
-                                    all_gdfs.append(gdf)
-                                    print(f"    変換完了: {len(gdf)}個の建物")
-                                
-                            except Exception as e:
-                                print(f"    エラー: {e}")
-                                continue
-        
-        if all_gdfs:
-            # すべてのGeoDataFrameを結合
-            print("GeoDataFrameを結合中...")
-            combined_gdf = gpd.pd.concat(all_gdfs, ignore_index=True)
+                if tqdm is None:
+                    print(f"処理完了 ({i}/{len(zip_files)}): {sub_zip_name} ({building_count}個の建物)")
+        
+        if all_building_data:
+            # すべての建物データを列ごとに連結し、GeoDataFrameは最後に一度だけ作成
+            print("建物データを結合中...")
+            merged = self.merge_building_data(all_building_data)
+            if self.drop_duplicates:
+                # ポリゴンを作成する前に重複する建物を除外
+                merged, removed = self.drop_duplicate_buildings(merged)
+                if removed:
+                    print(f"重複する建物を除外: {removed}件")
+            combined_gdf = self.to_geodataframe(merged, target_crs)
             print(f"結合完了: 総建物数 {len(combined_gdf)}")
             return combined_gdf
         else:
-            return gpd.GeoDataFrame()
+            return None
+
+
+# ワーカープロセスごとに開いたメインZIPファイルと変換クラス（_init_workerで設定）
+_main_zip = None
+_converter = None
+
+
+def _init_worker(zip_path: str, precision: str):
+    """ワーカープロセスの初期化（プロセスごとにメインZIPファイルを開く）"""
+    global _main_zip, _converter
+    _main_zip = zipfile.ZipFile(zip_path, 'r')
+    _converter = XMLToGeoJSONConverterGPD(precision)
+
+
+def _parse_sub_zip(sub_zip_name: str) -> List[Dict[str, Any]]:
+    """サブZIPファイル内の建物XMLファイルをパースし、建物データのリストを返す（ワーカープロセスで実行）"""
+    converter = _converter
+    results = []
+    
+    # サブZIPファイルをメモリに読み込む（ZIP内のストリームのままだと、
+    # 中央ディレクトリの参照や各ファイルへのシークのたびに先頭から解凍し直しになる）
+    sub_zip_data = io.BytesIO(_main_zip.read(sub_zip_name))
+    with zipfile.ZipFile(sub_zip_data, 'r') as sub_zip:
+        # サブZIP内のファイル一覧を取得
+        sub_file_list = sub_zip.namelist()
+        
+        # -BldA-を含むファイルを検索
+        building_files = converter.find_building_files(sub_file_list)
+        
+        for building_file in building_files:
+            try:
+                # XMLファイルを展開しながら逐次パース
+                with sub_zip.open(building_file) as xml_data:
+                    results.append(converter.parse_building_xml(xml_data))
+            except Exception as e:
+                print(f"    エラー ({building_file}): {e}")
+    
+    return results
+
+
+def write_geojson(gdf: 'gpd.GeoDataFrame', f, precision: str = 'f64') -> int:
+    """GeoDataFrameをorjsonで直接GeoJSON（FeatureCollection）としてバイナリファイルに書き出し、件数を返す
+    
+    座標はShapelyから連結した配列として取り出し、建物ごとのスライスをそのままJSONに変換する
+    （GDALのように1件ずつフィーチャーオブジェクトを作成しない）
+    f32の場合は座標をfloat32に戻してから書き出し、float64に変換した際の余分な桁を出力しない
+    """
+    import shapely
+    
+    _, coords, (ring_offsets, polygon_offsets) = shapely.to_ragged_array(gdf.geometry.values)
+    coords = coords.astype(COORD_DTYPES[precision], copy=False)
+    columns = [gdf[name].tolist() for name in PROPERTY_NAMES]
+    
+    f.write(b'{"type": "FeatureCollection", "features": [\n')
+    for i, values in enumerate(zip(*columns)):
+        rings = [
+            coords[ring_offsets[r]:ring_offsets[r + 1]]
+            for r in range(polygon_offsets[i], polygon_offsets[i + 1])
+        ]
+        feature = {
+            "type": "Feature",
+            "properties": dict(zip(PROPERTY_NAMES, values)),
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": rings
+            }
+        }
+        if i:
+            f.write(b',\n')
+        f.write(orjson.dumps(feature, option=orjson.OPT_SERIALIZE_NUMPY))
+    f.write(b'\n]}\n')
+    return len(gdf)
 
 
 def main():
@@ -174,6 +375,11 @@ def main():
     parser.add_argument('zip_file', help='基盤地図情報のZIPファイルパス')
     parser.add_argument('-o', '--output', default='buildings.geojson', help='出力ファイル名（デフォルト: buildings.geojson）')
     parser.add_argument('--max-files', type=int, help='処理するサブZIPファイルの最大数（テスト用）')
+    parser.add_argument('--precision', choices=list(COORD_DTYPES), default='f64',
+                        help='座標を保持する精度（f32はメモリ使用量が半分になるが精度は約1m。デフォルト: f64）')
+    parser.add_argument('--keep-duplicates', action='store_true',
+                        help='図郭の境界で重複する建物（同じfid）を除外せずにすべて出力')
+    parser.add_argument('--target-crs', help='出力する座標参照系（例: EPSG:6677）。省略時は経度・緯度（EPSG:4326）のまま出力')
     
     args = parser.parse_args()
     
@@ -183,16 +389,30 @@ def main():
     
     print("基盤地図情報の建物データをGeoJSONに変換中（GeoPandas版）...")
     
-    converter = XMLToGeoJSONConverterGPD()
-    gdf = converter.extract_and_convert_building_files(args.zip_file, args.max_files)
+    converter = XMLToGeoJSONConverterGPD(args.precision, drop_duplicates=not args.keep_duplicates)
+    gdf = converter.extract_and_convert_building_files(args.zip_file, args.max_files, args.target_crs)
     
-    if gdf.empty:
+    if gdf is None:
         print("建物データが見つかりませんでした。")
         return 1
     
     # GeoJSONファイルに出力
     print(f"GeoJSONファイルに出力中: {args.output}")
-    gdf.to_file(args.output, driver='GeoJSON')
+    if orjson is not None and not args.target_crs:
+        # 経度・緯度のままの場合は、GDALを経由せずorjsonで直接書き出し
+        with open(args.output, 'wb') as f:
+            write_geojson(gdf, f, converter.precision)
+    else:
+        try:
+            import pyogrio
+        except ImportError:  # pyogrioが無い環境ではGeoDataFrame.to_file（Fiona）で書き出し
+            pyogrio = None
+        
+        if pyogrio is not None:
+            # GDALの列指向APIでまとめて書き出し（Fionaのように1行ずつ変換しない）
+            pyogrio.write_dataframe(gdf, args.output, driver='GeoJSON')
+        else:
+            gdf.to_file(args.output, driver='GeoJSON')
     
     print(f"変換完了!")
     print(f"出力ファイル: {args.output}")